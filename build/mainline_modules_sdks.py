@@ -840,6 +840,9 @@ LATEST = BuildRelease(
     generate_gantry_metadata_and_api_diff=True,
 )
 
+# Map from the lower case name of a build release to the build release.
+BUILD_RELEASES_BY_NAME = {br.name.lower(): br for br in ALL_BUILD_RELEASES}
+
 
 @dataclasses.dataclass(frozen=True)
 class SdkLibrary:
@@ -1321,9 +1324,8 @@ class SdkDistProducer:
         sdk_modules_file = os.path.join(self.dist_dir, "sdk-modules.txt")
         os.makedirs(os.path.dirname(sdk_modules_file), exist_ok=True)
         with open(sdk_modules_file, "w", encoding="utf8") as file:
-            for module in modules:
-                if module in MAINLINE_MODULES:
-                    file.write(aosp_to_google_name(module.apex) + "\n")
+            for name in sdk_supported_module_names(modules):
+                file.write(name + "\n")
 
     def populate_unbundled_dist(self, build_release, modules, snapshots_dir):
         build_release_dist_dir = os.path.join(self.mainline_sdks_dir,
@@ -1499,6 +1501,13 @@ def google_to_aosp_name(name):
     return name.replace("com.google.android.", "com.android.")
 
 
+def sdk_supported_module_names(modules):
+    """Get the Google names of the modules that provide module sdks"""
+    return [
+        aosp_to_google_name(m.apex) for m in modules if m in MAINLINE_MODULES
+    ]
+
+
 @dataclasses.dataclass(frozen=True)
 class SdkType:
     name: str
@@ -1542,10 +1551,17 @@ def filter_modules(modules, target_build_apps):
     return modules
 
 
+# The directories that have already been checked to be the top of the tree.
+checked_top_dirs = set()
+
+
 def main(args):
     """Program entry point."""
-    if not os.path.exists("build/make/core/Makefile"):
-        sys.exit("This script must be run from the top of the tree.")
+    cwd = os.getcwd()
+    if cwd not in checked_top_dirs:
+        if not os.path.exists("build/make/core/Makefile"):
+            sys.exit("This script must be run from the top of the tree.")
+        checked_top_dirs.add(cwd)
 
     args_parser = argparse.ArgumentParser(
         description="Build snapshot zips for consumption by Gantry.")
@@ -1557,7 +1573,8 @@ def main(args):
     args_parser.add_argument(
         "--build-release",
         action="append",
-        choices=[br.name for br in ALL_BUILD_RELEASES],
+        type=str.lower,
+        choices=list(BUILD_RELEASES_BY_NAME),
         help="A target build for which snapshots are required. "
         "If it is \"latest\" then Mainline module SDKs from platform and "
         "bundled modules are included.",
@@ -1578,11 +1595,10 @@ def main(args):
 
     build_releases = ALL_BUILD_RELEASES
     if args.build_release:
-        selected_build_releases = {b.lower() for b in args.build_release}
-        build_releases = [
-            b for b in build_releases
-            if b.name.lower() in selected_build_releases
-        ]
+        # Sort the selected build releases so that they are built in the same
+        # order as ALL_BUILD_RELEASES, irrespective of the order specified.
+        build_releases = sorted(
+            BUILD_RELEASES_BY_NAME[b] for b in set(args.build_release))
 
     target_build_apps = os.environ.get("TARGET_BUILD_APPS")
     modules = filter_modules(MAINLINE_MODULES + BUNDLED_MAINLINE_MODULES,
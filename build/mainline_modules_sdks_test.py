@@ -15,12 +15,13 @@
 # limitations under the License.
 """Unit tests for mainline_modules_sdks.py."""
 import dataclasses
-import re
+import functools
+import io
 import typing
-from pathlib import Path
 import os
 import shutil
 import tempfile
+import types
 import unittest
 import zipfile
 import json
@@ -28,9 +29,12 @@ from unittest import mock
 
 import mainline_modules_sdks as mm
 
-MAINLINE_MODULES_BY_APEX = dict(
-    (m.apex, m) for m in (mm.MAINLINE_MODULES + mm.BUNDLED_MAINLINE_MODULES +
-                          mm.PLATFORM_SDKS_FOR_MAINLINE))
+# A read only view so that a test cannot accidentally affect other tests by
+# modifying it.
+MAINLINE_MODULES_BY_APEX = types.MappingProxyType({
+    m.apex: m for m in (mm.MAINLINE_MODULES + mm.BUNDLED_MAINLINE_MODULES +
+                        mm.PLATFORM_SDKS_FOR_MAINLINE)
+})
 
 
 @dataclasses.dataclass()
@@ -44,30 +48,56 @@ class FakeSnapshotBuilder(mm.SnapshotBuilder):
     snapshots: typing.List[typing.Any] = dataclasses.field(default_factory=list)
 
     @staticmethod
-    def create_sdk_library_files(z, name):
-        z.writestr(f"sdk_library/public/{name}-removed.txt", "")
-        z.writestr(f"sdk_library/public/{name}.srcjar", "")
-        z.writestr(f"sdk_library/public/{name}-stubs.jar", "")
-        z.writestr(f"sdk_library/public/{name}.txt",
-                   "method public int testMethod(int);")
+    def sdk_library_files(name):
+        """Get the (path, contents) of the fake files for an sdk library."""
+        return [
+            (f"sdk_library/public/{name}-removed.txt", ""),
+            (f"sdk_library/public/{name}.srcjar", ""),
+            (f"sdk_library/public/{name}-stubs.jar", ""),
+            (f"sdk_library/public/{name}.txt",
+             "method public int testMethod(int);"),
+        ]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def snapshot_zip_contents(library_names):
+        """Get the bytes of a fake snapshot zip for the sdk libraries.
+
+        The contents only depend on the library names, and the entries use a
+        fixed time, so each distinct zip is only built once.
+        """
+        files = [("Android.bp", "")]
+        for library_name in library_names:
+            files.extend(FakeSnapshotBuilder.sdk_library_files(library_name))
+
+        buffer = io.BytesIO()
+        date_time = mm.default_zip_time.timetuple()[:6]
+        # The entries are empty or tiny so store them uncompressed rather than
+        # paying for deflate.
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as z:
+            for path, contents in files:
+                z.writestr(zipfile.ZipInfo(path, date_time), contents)
+        return buffer.getvalue()
 
     def create_snapshot_file(self, out_dir, name, for_r_build):
-        zip_file = Path(mm.sdk_snapshot_zip_file(out_dir, name))
-        with zipfile.ZipFile(zip_file, "w") as z:
-            z.writestr("Android.bp", "")
-            if name.endswith("-sdk"):
-                if for_r_build:
-                    for library in for_r_build.sdk_libraries:
-                        self.create_sdk_library_files(z, library.name)
-                else:
-                    self.create_sdk_library_files(z, re.sub(r"-.*$", "", name))
+        library_names = ()
+        if mm.sdk_type_from_name(name).providesApis:
+            if for_r_build:
+                library_names = tuple(
+                    library.name for library in for_r_build.sdk_libraries)
+            else:
+                library_names = (name.partition("-")[0],)
+
+        zip_file = mm.sdk_snapshot_zip_file(out_dir, name)
+        with open(zip_file, "wb") as f:
+            f.write(self.snapshot_zip_contents(library_names))
 
     def build_snapshots(self, build_release, modules):
         self.snapshots.append((build_release.name, build_release.soong_env,
                                [m.apex for m in modules]))
         # Create input file structure.
-        sdks_out_dir = Path(self.mainline_sdks_dir).joinpath("test")
-        sdks_out_dir.mkdir(parents=True, exist_ok=True)
+        sdks_out_dir = os.path.join(self.mainline_sdks_dir, "test")
+        os.makedirs(sdks_out_dir, exist_ok=True)
         # Create a fake sdk zip file for each module.
         for module in modules:
             for sdk in module.sdks:
@@ -75,6 +105,8 @@ class FakeSnapshotBuilder(mm.SnapshotBuilder):
         return sdks_out_dir
 
     def get_art_module_info_file_data(self, sdk):
+        name = sdk.partition("-")[0]
+        sdks_out_dir = os.path.join(self.mainline_sdks_dir, "test")
         info_file_data = f"""[
   {{
     "@type": "java_sdk_library",
@@ -85,10 +117,10 @@ class FakeSnapshotBuilder(mm.SnapshotBuilder):
     "dist_stem": "art",
     "scopes": {{
       "public": {{
-        "current_api": "sdk_library/public/{re.sub(r"-.*$", "", sdk)}.txt",
-        "latest_api": "{Path(self.mainline_sdks_dir).joinpath("test")}/prebuilts/sdk/art.api.public.latest/gen/art.api.public.latest",
-        "latest_removed_api": "{Path(self.mainline_sdks_dir).joinpath("test")}/prebuilts/sdk/art-removed.api.public.latest/gen/art-removed.api.public.latest",
-        "removed_api": "sdk_library/public/{re.sub(r"-.*$", "", sdk)}-removed.txt"
+        "current_api": "sdk_library/public/{name}.txt",
+        "latest_api": "{sdks_out_dir}/prebuilts/sdk/art.api.public.latest/gen/art.api.public.latest",
+        "latest_removed_api": "{sdks_out_dir}/prebuilts/sdk/art-removed.api.public.latest/gen/art-removed.api.public.latest",
+        "removed_api": "sdk_library/public/{name}-removed.txt"
       }}
     }}
   }}
@@ -98,8 +130,8 @@ class FakeSnapshotBuilder(mm.SnapshotBuilder):
 
     @staticmethod
     def write_data_to_file(file, data):
-        with open(file, "w", encoding="utf8") as fd:
-            fd.write(data)
+        with open(file, "wb") as fd:
+            fd.write(data.encode("utf8"))
 
     def create_snapshot_info_file(self, module, sdk_info_file, sdk):
         if module == MAINLINE_MODULES_BY_APEX["com.android.art"]:
@@ -122,59 +154,96 @@ class FakeSnapshotBuilder(mm.SnapshotBuilder):
                     continue
 
                 sdk_info_file = mm.sdk_snapshot_info_file(
-                    Path(self.mainline_sdks_dir).joinpath("test"), sdk)
+                    os.path.join(self.mainline_sdks_dir, "test"), sdk)
                 self.create_snapshot_info_file(module, sdk_info_file, sdk)
                 paths, dict_item = self.latest_api_file_targets(sdk_info_file)
                 target_paths.extend(paths)
                 target_dict[sdk_info_file] = dict_item
 
+        for target_dir in {os.path.dirname(p) for p in target_paths}:
+            os.makedirs(target_dir, exist_ok=True)
+
+        extension_version = str(self.get_module_extension_version())
         for target_path in target_paths:
-            os.makedirs(os.path.split(target_path)[0])
             if ".latest.extension_version" in target_path:
-                self.write_data_to_file(
-                    target_path, str(self.get_module_extension_version()))
+                self.write_data_to_file(target_path, extension_version)
             else:
-               self.write_data_to_file(target_path, "")
+                self.write_data_to_file(target_path, "")
 
         return target_dict
 
 
 class TestProduceDist(unittest.TestCase):
 
-    def setUp(self):
-        self.tmp_dir = tempfile.mkdtemp()
-        self.tmp_out_dir = os.path.join(self.tmp_dir, "out")
-        os.mkdir(self.tmp_out_dir)
-        self.tmp_dist_dir = os.path.join(self.tmp_dir, "dist")
-        os.mkdir(self.tmp_dist_dir)
-
-    def tearDown(self):
-        shutil.rmtree(self.tmp_dir, ignore_errors=True)
-
-    def produce_dist(self, modules, build_releases):
-        subprocess_runner = mm.SubprocessRunner()
-        snapshot_builder = FakeSnapshotBuilder(
+    @classmethod
+    def setUpClass(cls):
+        # The producer only depends on the paths of the out and dist
+        # directories so create it once and just recreate those directories
+        # for each test.
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.tmp_out_dir = os.path.join(cls.tmp_dir.name, "out")
+        cls.tmp_dist_dir = os.path.join(cls.tmp_dir.name, "dist")
+        cls.subprocess_runner = mm.SubprocessRunner()
+        cls.snapshot_builder = FakeSnapshotBuilder(
             tool_path="path/to/mainline_modules_sdks.sh",
-            subprocess_runner=subprocess_runner,
-            out_dir=self.tmp_out_dir,
+            subprocess_runner=cls.subprocess_runner,
+            out_dir=cls.tmp_out_dir,
         )
-        producer = mm.SdkDistProducer(
-            subprocess_runner=subprocess_runner,
-            snapshot_builder=snapshot_builder,
-            dist_dir=self.tmp_dist_dir,
+        cls.producer = mm.SdkDistProducer(
+            subprocess_runner=cls.subprocess_runner,
+            snapshot_builder=cls.snapshot_builder,
+            dist_dir=cls.tmp_dist_dir,
         )
-        producer.produce_dist(modules, build_releases)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        for d in (self.tmp_out_dir, self.tmp_dist_dir):
+            os.mkdir(d)
+            self.addCleanup(shutil.rmtree, d, ignore_errors=True)
+        self.snapshot_builder.snapshots.clear()
+
+    def produce_dist(self, modules, build_releases):
+        self.producer.produce_dist(modules, build_releases)
 
     def list_files_in_dir(self, tmp_dist_dir):
+        """List the relative paths of the files in tmp_dist_dir in order.
+
+        Each directory's entries are sorted before visiting them so the paths
+        are produced in sorted order without having to sort the whole list.
+        A directory is sorted as if its name ended with "/" so that its
+        contents are ordered correctly relative to its siblings.
+        """
+        def sorted_entries(abs_dir, prefix):
+            with os.scandir(abs_dir) as it:
+                entries = [(e.name + "/" if e.is_dir(follow_symlinks=False)
+                            else e.name, e) for e in it]
+            entries.sort(key=lambda item: item[0])
+            return [(e, prefix + e.name) for _, e in entries]
+
         files = []
-        for abs_dir, _, filenames in os.walk(tmp_dist_dir):
-            rel_dir = os.path.relpath(abs_dir, tmp_dist_dir)
-            if rel_dir == ".":
-                rel_dir = ""
-            for f in filenames:
-                files.append(os.path.join(rel_dir, f))
+        # A stack of the entries still to visit, with the next one at the end.
+        # The relative paths are built by simple concatenation as they only
+        # ever use "/" separators.
+        stack = sorted_entries(tmp_dist_dir, "")[::-1]
+        while stack:
+            entry, rel_path = stack.pop()
+            if entry.is_dir(follow_symlinks=False):
+                stack.extend(sorted_entries(entry.path, rel_path + "/")[::-1])
+            else:
+                files.append(rel_path)
         return files
 
+    def assert_files_in_dir(self, expected, tmp_dir):
+        """Check that the files in tmp_dir match the expected relative paths.
+
+        The files are listed in sorted order so they can be compared directly
+        against the sorted expected paths.
+        """
+        self.assertEqual(expected, self.list_files_in_dir(tmp_dir))
+
     def test_unbundled_modules(self):
         # Create the out/soong/build_number.txt file that is copied into the
         # snapshots.
@@ -196,7 +265,7 @@ class TestProduceDist(unittest.TestCase):
         self.produce_dist(modules, build_releases)
 
         # pylint: disable=line-too-long
-        self.assertEqual(
+        self.assert_files_in_dir(
             [
                 # Build specific snapshots.
                 "mainline-sdks/for-R-build/current/com.android.ipsec/sdk/ipsec-module-sdk-current.zip",
@@ -222,15 +291,14 @@ class TestProduceDist(unittest.TestCase):
                 "mainline-sdks/for-latest-build/current/com.google.android.wifi/gantry-metadata.json",
                 "mainline-sdks/for-latest-build/current/com.google.android.wifi/sdk/wifi-module-sdk-current-api-diff.txt",
                 "mainline-sdks/for-latest-build/current/com.google.android.wifi/sdk/wifi-module-sdk-current.zip",
-            ],
-            sorted(self.list_files_in_dir(self.tmp_dist_dir)))
+            ], self.tmp_dist_dir)
 
         r_snaphot_dir = os.path.join(self.tmp_out_dir,
                                      "soong/mainline-sdks/test/for-R-build")
         aosp_ipsec_r_bp_file = "com.android.ipsec/sdk_library/Android.bp"
         aosp_tethering_r_bp_file = "com.android.tethering/sdk_library/Android.bp"
         google_wifi_android_bp = "com.google.android.wifi/sdk_library/Android.bp"
-        self.assertEqual([
+        self.assert_files_in_dir([
             aosp_ipsec_r_bp_file,
             "com.android.ipsec/sdk_library/public/android.net.ipsec.ike-removed.txt",
             "com.android.ipsec/sdk_library/public/android.net.ipsec.ike-stubs.jar",
@@ -252,7 +320,7 @@ class TestProduceDist(unittest.TestCase):
             "ipsec-module-sdk-current.zip",
             "tethering-module-sdk-current.zip",
             "wifi-module-sdk-current.zip",
-        ], sorted(self.list_files_in_dir(r_snaphot_dir)))
+        ], r_snaphot_dir)
 
         def read_r_snapshot_contents(path):
             abs_path = os.path.join(r_snaphot_dir, path)
@@ -284,11 +352,11 @@ class TestProduceDist(unittest.TestCase):
         self.produce_dist(modules, build_releases)
 
         # pylint: disable=line-too-long
-        self.assertEqual([
+        self.assert_files_in_dir([
             "mainline-sdks/for-S-build/current/com.android.art/host-exports/art-module-host-exports-current.zip",
             "mainline-sdks/for-S-build/current/com.android.art/sdk/art-module-sdk-current.zip",
             "mainline-sdks/for-S-build/current/com.android.art/test-exports/art-module-test-exports-current.zip",
-        ], sorted(self.list_files_in_dir(self.tmp_dist_dir)))
+        ], self.tmp_dist_dir)
 
     def test_latest_release(self):
         modules = [
@@ -300,7 +368,7 @@ class TestProduceDist(unittest.TestCase):
         self.produce_dist(modules, build_releases)
 
         # pylint: disable=line-too-long
-        self.assertEqual(
+        self.assert_files_in_dir(
             [
                 # Bundled modules and platform SDKs.
                 "bundled-mainline-sdks/com.android.runtime/host-exports/runtime-module-host-exports-current.zip",
@@ -313,8 +381,7 @@ class TestProduceDist(unittest.TestCase):
                 "mainline-sdks/for-latest-build/current/com.android.art/sdk/art-module-sdk-current-api-diff.txt",
                 "mainline-sdks/for-latest-build/current/com.android.art/sdk/art-module-sdk-current.zip",
                 "mainline-sdks/for-latest-build/current/com.android.art/test-exports/art-module-test-exports-current.zip",
-            ],
-            sorted(self.list_files_in_dir(self.tmp_dist_dir)))
+            ], self.tmp_dist_dir)
 
         art_api_diff_file = os.path.join(
             self.tmp_dist_dir,
@@ -330,8 +397,8 @@ class TestProduceDist(unittest.TestCase):
             "mainline-sdks/for-latest-build/current/com.android.art/gantry-metadata.json"
         )
 
-        with open(art_gantry_metadata_json_file, "r",
-                  encoding="utf8") as gantry_metadata_json_file_object:
+        with open(art_gantry_metadata_json_file,
+                  "rb") as gantry_metadata_json_file_object:
             json_data = json.load(gantry_metadata_json_file_object)
 
         self.assertEqual(
@@ -357,24 +424,25 @@ class TestProduceDist(unittest.TestCase):
         soong_dir = os.path.join(self.tmp_out_dir, "soong")
         os.makedirs(soong_dir, exist_ok=True)
         build_number_file = os.path.join(soong_dir, "build_number.txt")
-        with open(build_number_file, "w", encoding="utf8") as f:
-            f.write("build-number")
+        with open(build_number_file, "wb") as f:
+            f.write(b"build-number")
 
     def test_snapshot_build_order(self):
         # Create the out/soong/build_number.txt file that is copied into the
         # snapshots.
         self.create_build_number_file()
 
+        # Reuse the shared builder and producer but with a mock runner.
         subprocess_runner = unittest.mock.Mock(mm.SubprocessRunner)
-        snapshot_builder = FakeSnapshotBuilder(
-            tool_path="path/to/mainline_modules_sdks.sh",
+        snapshot_builder = dataclasses.replace(
+            self.snapshot_builder,
             subprocess_runner=subprocess_runner,
-            out_dir=self.tmp_out_dir,
+            snapshots=[],
         )
-        producer = mm.SdkDistProducer(
+        producer = dataclasses.replace(
+            self.producer,
             subprocess_runner=subprocess_runner,
             snapshot_builder=snapshot_builder,
-            dist_dir=self.tmp_dist_dir,
         )
 
         modules = [
@@ -420,84 +488,55 @@ class TestProduceDist(unittest.TestCase):
         ], snapshot_builder.snapshots)
 
     def test_generate_sdk_supported_modules_file(self):
-        subprocess_runner = mm.SubprocessRunner()
-        snapshot_builder = FakeSnapshotBuilder(
-            tool_path="path/to/mainline_modules_sdks.sh",
-            subprocess_runner=subprocess_runner,
-            out_dir=self.tmp_out_dir,
+        adservices = MAINLINE_MODULES_BY_APEX["com.android.adservices"]
+        art = MAINLINE_MODULES_BY_APEX["com.android.art"]
+        mediaprovider = MAINLINE_MODULES_BY_APEX["com.android.mediaprovider"]
+        adbd = mm.MainlineModule(
+            apex="com.android.adbd",
+            sdks=[],
+            first_release="",
         )
-        producer = mm.SdkDistProducer(
-            subprocess_runner=subprocess_runner,
-            snapshot_builder=snapshot_builder,
-            dist_dir=self.tmp_dist_dir,
-        )
-        producer = mm.SdkDistProducer(
-            subprocess_runner=subprocess_runner,
-            snapshot_builder=snapshot_builder,
-            dist_dir=self.tmp_dist_dir,
-        )
-
-        # Contains only sdk modules.
-        modules = [
-            MAINLINE_MODULES_BY_APEX["com.android.adservices"],
-            MAINLINE_MODULES_BY_APEX["com.android.art"],
-            MAINLINE_MODULES_BY_APEX["com.android.mediaprovider"],
-        ]
-        producer.dist_generate_sdk_supported_modules_file(modules)
-        with open(os.path.join(self.tmp_dist_dir, "sdk-modules.txt"), "r",
-                  encoding="utf8") as sdk_modules_file:
-            sdk_modules = sdk_modules_file.readlines()
 
-        self.assertTrue("com.google.android.adservices\n" in sdk_modules)
-        self.assertTrue("com.google.android.art\n" in sdk_modules)
-        self.assertTrue("com.google.android.mediaprovider\n" in sdk_modules)
-
-        # Contains only non-sdk modules.
-        modules = [
-            mm.MainlineModule(
-                apex="com.android.adbd",
-                sdks=[],
-                first_release="",
-            ),
-            mm.MainlineModule(
-                apex="com.android.adbd",
-                sdks=[],
-                first_release="",
+        cases = [
+            (
+                "only sdk modules",
+                [adservices, art, mediaprovider],
+                [
+                    "com.google.android.adservices",
+                    "com.google.android.art",
+                    "com.google.android.mediaprovider",
+                ],
             ),
-        ]
-        producer.dist_generate_sdk_supported_modules_file(modules)
-        with open(os.path.join(self.tmp_dist_dir, "sdk-modules.txt"), "r",
-                  encoding="utf8") as sdk_modules_file:
-            sdk_modules = sdk_modules_file.readlines()
-
-        self.assertEqual(len(sdk_modules), 0)
-
-        # Contains mixture of sdk and non-sdk modules.
-        modules = [
-            MAINLINE_MODULES_BY_APEX["com.android.adservices"],
-            MAINLINE_MODULES_BY_APEX["com.android.mediaprovider"],
-            mm.MainlineModule(
-                apex="com.android.adbd",
-                sdks=[],
-                first_release="",
+            (
+                "only non-sdk modules",
+                [adbd, adbd],
+                [],
             ),
-            mm.MainlineModule(
-                apex="com.android.adbd",
-                sdks=[],
-                first_release="",
+            (
+                "mixture of sdk and non-sdk modules",
+                [adservices, mediaprovider, adbd, adbd],
+                [
+                    "com.google.android.adservices",
+                    "com.google.android.mediaprovider",
+                ],
             ),
         ]
-        producer.dist_generate_sdk_supported_modules_file(modules)
+        for description, modules, expected in cases:
+            with self.subTest(description):
+                self.assertEqual(expected,
+                                 mm.sdk_supported_module_names(modules))
+
+        # Check the generated file for the mixed case.
+        _, modules, expected = cases[-1]
+        self.producer.dist_generate_sdk_supported_modules_file(modules)
         with open(os.path.join(self.tmp_dist_dir, "sdk-modules.txt"), "r",
                   encoding="utf8") as sdk_modules_file:
             sdk_modules = sdk_modules_file.readlines()
 
-        self.assertTrue("com.google.android.adservices\n" in sdk_modules)
-        self.assertTrue("com.google.android.mediaprovider\n" in sdk_modules)
-        self.assertFalse("com.google.android.adbd\n" in sdk_modules)
-        self.assertFalse("com.google.android.extservices\n" in sdk_modules)
+        self.assertEqual([m + "\n" for m in expected], sdk_modules)
 
 
+@functools.lru_cache(maxsize=None)
 def path_to_test_data(relative_path):
     """Construct a path to a test data file.
 
@@ -518,6 +557,8 @@ def path_to_test_data(relative_path):
     return os.path.join(this_file_without_ext + "_data", relative_path)
 
 
+# The test data files are never modified so only read each one once.
+@functools.lru_cache(maxsize=None)
 def read_test_data(relative_path):
     with open(path_to_test_data(relative_path), "r", encoding="utf8") as f:
         return f.read()
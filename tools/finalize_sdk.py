@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import functools
 import glob
 import os
 import re
@@ -26,6 +28,20 @@ BUILD_TARGET_CONTINUOUS = 'mainline_modules_sdks-userdebug'
 ARTIFACT_PATTERN = 'mainline-sdks/for-next-build/current/{module_name}/sdk/*.zip'
 # The glob of sdk artifacts to fetch from local build
 ARTIFACT_LOCAL_PATTERN = 'out/dist/mainline-sdks/for-next-build/current/{module_name}/sdk/*.zip'
+# Conscrypt has some legacy API tracking files that we don't consider for extensions.
+BAD_STEM_PREFIXES = ('conscrypt.module.intra.core.api', 'conscrypt.module.platform.api')
+COMPAT_STEM_REPLACEMENTS = {
+    # For legacy reasons, art and conscrypt txt file names in the SDKs (*.module.public.api)
+    # do not match their expected filename in prebuilts/sdk (art, conscrypt). So rename them
+    # to match.
+    'art.module.public.api': 'art',
+    'conscrypt.module.public.api': 'conscrypt',
+    # The stub jar artifacts from official builds are named '*-stubs.jar', but
+    # the convention for the copies in prebuilts/sdk is just '*.jar'. Fix that.
+    '-stubs': '',
+}
+COMPAT_STEM_RE = re.compile('|'.join(re.escape(s) for s in COMPAT_STEM_REPLACEMENTS))
+CHANGE_ID_RE = re.compile(r'Change-Id: [^\n]+')
 COMMIT_TEMPLATE = """Finalize artifacts for extension SDK %d
 
 Import from build id %s.
@@ -40,14 +56,16 @@ def fail(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
     sys.exit(1)
 
+# Returns the dir to fetch into and a function that does the fetch, so that the
+# fetch can run on another thread while its progress is printed from this one.
 def fetch_artifacts(target, build_id, module_name):
-    tmpdir = Path(tempfile.TemporaryDirectory().name)
-    tmpdir.mkdir()
+    tmpdir = Path(tempfile.mkdtemp(prefix='finalize_sdk_'))
     if args.local_mode:
         artifact_path = ARTIFACT_LOCAL_PATTERN.format(module_name='*')
         print('Copying %s to %s ...' % (artifact_path, tmpdir))
-        for file in glob.glob(artifact_path):
-            shutil.copy(file, tmpdir)
+        def fetch():
+            for file in glob.glob(artifact_path):
+                shutil.copy(file, tmpdir)
     else:
         artifact_path = ARTIFACT_PATTERN.format(module_name=module_name)
         print('Fetching %s from %s ...' % (artifact_path, target))
@@ -57,14 +75,22 @@ def fetch_artifacts(target, build_id, module_name):
         fetch_cmd.append(artifact_path)
         fetch_cmd.append(str(tmpdir))
         print("Running: " + ' '.join(fetch_cmd))
-        try:
-            subprocess.check_output(fetch_cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            fail('FAIL: Unable to retrieve %s artifact for build ID %s' % (artifact_path, build_id))
-    return tmpdir
+        def fetch():
+            try:
+                subprocess.run(fetch_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            except subprocess.CalledProcessError as e:
+                fail('FAIL: Unable to retrieve %s artifact for build ID %s:\n%s' % (artifact_path, build_id, e.stderr))
+    return tmpdir, fetch
 
 def repo_for_sdk(filename):
-    module = filename.split('-')[0]
+    repo = repo_for_module(filename.split('-')[0])
+    if not repo:
+        fail('Could not find a target dir for %s' % filename)
+    return repo
+
+# Every sdk of a module is in the same repo so only look it up once.
+@functools.lru_cache(maxsize=None)
+def repo_for_module(module):
     target_dir = ''
     if module == 'btservices': return Path('prebuilts/module_sdk/Bluetooth')
     if module == 'media': return Path('prebuilts/module_sdk/Media')
@@ -76,7 +102,7 @@ def repo_for_sdk(filename):
                 fail('Multiple target dirs matched "%s": %s' % (module, (target_dir, dir)))
             target_dir = dir
     if not target_dir:
-        fail('Could not find a target dir for %s' % filename)
+        return None
 
     return Path('prebuilts/module_sdk/%s' % target_dir)
 
@@ -88,25 +114,26 @@ def dir_for_sdk(filename, version):
         return os.path.join(base, 'host-exports')
     return base
 
+def sdk_library_files(target_dir):
+    # Yield the api txt and stub jar files in target_dir/sdk_library/*/.
+    sdk_library_dir = target_dir.joinpath('sdk_library')
+    if not sdk_library_dir.is_dir():
+        return
+    with os.scandir(sdk_library_dir) as api_type_dirs:
+        for api_type_dir in api_type_dirs:
+            if api_type_dir.name.startswith('.') or not api_type_dir.is_dir():
+                continue
+            with os.scandir(api_type_dir.path) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('.') and entry.name.endswith(('.txt', '.jar')):
+                        yield Path(entry.path)
+
 def is_ignored(file):
-    # Conscrypt has some legacy API tracking files that we don't consider for extensions.
-    bad_stem_prefixes = ['conscrypt.module.intra.core.api', 'conscrypt.module.platform.api']
-    return any([file.stem.startswith(p) for p in bad_stem_prefixes])
+    return file.stem.startswith(BAD_STEM_PREFIXES)
 
 
 def maybe_tweak_compat_stem(file):
-    # For legacy reasons, art and conscrypt txt file names in the SDKs (*.module.public.api)
-    # do not match their expected filename in prebuilts/sdk (art, conscrypt). So rename them
-    # to match.
-    new_stem = file.stem
-    new_stem = new_stem.replace('art.module.public.api', 'art')
-    new_stem = new_stem.replace('conscrypt.module.public.api', 'conscrypt')
-
-    # The stub jar artifacts from official builds are named '*-stubs.jar', but
-    # the convention for the copies in prebuilts/sdk is just '*.jar'. Fix that.
-    new_stem = new_stem.replace('-stubs', '')
-
-    return file.with_stem(new_stem)
+    return file.with_stem(COMPAT_STEM_RE.sub(lambda m: COMPAT_STEM_REPLACEMENTS[m.group(0)], file.stem))
 
 if not os.path.isdir('build/soong'):
     fail("This script must be run from the top of an Android source tree.")
@@ -133,8 +160,8 @@ if compat_dir.is_dir():
     shutil.rmtree(compat_dir)
 
 created_dirs = defaultdict(set)
-for m in module_names:
-    tmpdir = fetch_artifacts(build_target, args.bid, m)
+
+def extract_artifacts(tmpdir):
     for f in tmpdir.iterdir():
         repo = repo_for_sdk(f.name)
         dir = dir_for_sdk(f.name, args.finalize_sdk)
@@ -143,17 +170,20 @@ for m in module_names:
             print('Removing existing dir %s' % target_dir)
             shutil.rmtree(target_dir)
         with zipfile.ZipFile(tmpdir.joinpath(f)) as zipFile:
-            zipFile.extractall(target_dir)
-
-        # Disable the Android.bp, but keep it for reference / potential future use.
-        shutil.move(target_dir.joinpath('Android.bp'), target_dir.joinpath('Android.bp.auto'))
+            for info in zipFile.infolist():
+                if info.filename == 'Android.bp':
+                    # Disable the Android.bp, but keep it for reference / potential future use.
+                    target_dir.mkdir(parents=True, exist_ok=True)
+                    with zipFile.open(info) as src, open(target_dir.joinpath('Android.bp.auto'), 'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+                else:
+                    zipFile.extract(info, target_dir)
 
         print('Created %s' % target_dir)
         created_dirs[repo].add(dir)
 
         # Copy api txt files to compat tracking dir
-        src_files = [Path(p) for p in glob.glob(os.path.join(target_dir, 'sdk_library/*/*.txt')) + glob.glob(os.path.join(target_dir, 'sdk_library/*/*.jar'))]
-        for src_file in src_files:
+        for src_file in sdk_library_files(target_dir):
             if is_ignored(src_file):
                 continue
             api_type = src_file.parts[-2]
@@ -163,23 +193,59 @@ for m in module_names:
             shutil.copy(src_file, dest_file)
             created_dirs[COMPAT_REPO].add(dest_dir.relative_to(COMPAT_REPO))
 
+# Each fetch is a separate remote request so run them in parallel. The fetched
+# artifacts are processed one module at a time, in order, as soon as they are
+# available.
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    fetches = []
+    for m in module_names:
+        tmpdir, fetch = fetch_artifacts(build_target, args.bid, m)
+        fetches.append((tmpdir, executor.submit(fetch)))
+    try:
+        while fetches:
+            tmpdir, fetch = fetches[0]
+            fetch.result()
+            extract_artifacts(tmpdir)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            fetches.pop(0)
+    finally:
+        # If processing stopped early, don't leave behind the artifacts of the
+        # modules that were not processed.
+        for _, fetch in fetches:
+            fetch.cancel()
+        concurrent.futures.wait([fetch for _, fetch in fetches])
+        for tmpdir, _ in fetches:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
 if args.local_mode:
     print('Updated prebuilts using locally built artifacts. Don\'t submit or use for anything besides local testing.')
     sys.exit(0)
 
-subprocess.check_output(['repo', 'start', branch_name] + list(created_dirs.keys()))
+subprocess.run(['repo', 'start', branch_name] + list(created_dirs.keys()), check=True, stdout=subprocess.DEVNULL)
 print('Running git commit')
-for repo in created_dirs:
+if COMPAT_REPO in created_dirs:
+    with open(COMPAT_REPO / COMPAT_README, "a") as readme:
+        readme.write(f"- {args.finalize_sdk}: {args.readme}\n")
+
+def commit_repo(repo):
     git = ['git', '-C', str(repo)]
-    subprocess.check_output(git + ['add'] + list(created_dirs[repo]))
+    subprocess.run(git + ['add'] + list(created_dirs[repo]), check=True, stdout=subprocess.DEVNULL)
 
     if repo == COMPAT_REPO:
-        with open(COMPAT_REPO / COMPAT_README, "a") as readme:
-            readme.write(f"- {args.finalize_sdk}: {args.readme}\n")
-        subprocess.check_output(git + ['add', COMPAT_README])
+        subprocess.run(git + ['add', COMPAT_README], check=True, stdout=subprocess.DEVNULL)
 
     if args.amend_last_commit:
-        change_id = '\n' + re.search(r'Change-Id: [^\\n]+', str(subprocess.check_output(git + ['log', '-1']))).group(0)
-        subprocess.check_output(git + ['commit', '--amend', '-m', commit_message + change_id])
+        change_id = '\n' + CHANGE_ID_RE.search(subprocess.check_output(git + ['log', '-1'], text=True)).group(0)
+        subprocess.run(git + ['commit', '--amend', '-m', commit_message + change_id], check=True, stdout=subprocess.DEVNULL)
     else:
-        subprocess.check_output(git + ['commit', '-m', commit_message])
+        subprocess.run(git + ['commit', '-m', commit_message], check=True, stdout=subprocess.DEVNULL)
+
+# Each repo is independent so commit them all at once, but don't start on any
+# more repos once one has failed.
+with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, max(1, len(created_dirs)))) as executor:
+    commits = [executor.submit(commit_repo, repo) for repo in created_dirs]
+    done, not_done = concurrent.futures.wait(commits, return_when=concurrent.futures.FIRST_EXCEPTION)
+    for commit in not_done:
+        commit.cancel()
+    for commit in done:
+        commit.result()